@@ -66,20 +66,20 @@ class rl_reversal:
 
     # ---------- Interaction functions ---------- #
     @staticmethod
-    def eval_fn(row, subj):
+    def eval_fn(block, t, subj):
     
         # see state 
-        stage  = row['stage']
-        s      = int(row['state'])
-        m0     = row['m0']
-        m1     = row['m1']
+        stage  = block['stage'][t]
+        s      = int(block['state'][t])
+        m0     = block['m0'][t]
+        m1     = block['m1'][t]
         m      = np.array([m0, m1])
-        t_type = row['trial_type']
-        f_type = row['feedback_type'] 
+        t_type = block['trial_type'][t]
+        f_type = block['feedback_type'][t] 
         pi     = subj.policy(m,
                     t_type=t_type,
                     f_type=f_type)
-        a      = int(row['a'])
+        a      = int(block['a'][t])
         ll     = np.log(pi[a]+eps_)
 
         # save the info and learn 
@@ -93,23 +93,52 @@ class rl_reversal:
             subj.learn()
 
         return ll
+
+    @staticmethod
+    def prep_fn(block):
+        '''Add the numeric arrays used by eval_block_fn,
+        built once per fit
+        '''
+        block['_a']     = block['a'].astype(np.int64)
+        block['_m']     = np.column_stack([block['m0'], block['m1']])
+        block['_train'] = block['stage'] == 'train'
+        return block
+
+    @classmethod
+    def has_block_eval(cls):
+        '''eval_block_fn computes the eval_fn defined here,
+        so subclasses that override eval_fn can not use it
+        '''
+        return cls.eval_fn is rl_reversal.eval_fn
+
+    @staticmethod
+    def eval_block_fn(block, subj):
+        '''eval_fn over the whole block in one call, 
+        for agents with a compiled block_loglike;
+        return the per-trial log likelihood
+        '''
+        # blocks that skipped prep_fn, copied so the input is not changed
+        if '_m' not in block: 
+            block = rl_reversal.prep_fn({k: np.asarray(block[k]) for k in block.keys()})
+        return subj.block_loglike(block['state'], block['_a'], 
+                                  block['_m'], block['_train'])
     
     @staticmethod
-    def sim_fn(row, subj, rng):
+    def sim_fn(block, t, subj, rng):
         
         # see state 
-        stage  = row['stage']
-        s      = int(row['state'])
-        m0     = row['m0']
-        m1     = row['m1']
+        stage  = block['stage'][t]
+        s      = int(block['state'][t])
+        m0     = block['m0'][t]
+        m1     = block['m1'][t]
         m      = np.array([m0, m1])
-        t_type = row['trial_type']
-        f_type = row['feedback_type'] 
+        t_type = block['trial_type'][t]
+        f_type = block['feedback_type'][t] 
         pi     = subj.policy(m,
                     t_type=t_type,
                     f_type=f_type)
         a      = int(rng.choice(rl_reversal.nA, p=pi)) 
-        r      = (a==s)*eval(f'm{int(a)}')
+        r      = (a==s)*m[a]
 
         # save the info and learn 
         if stage == 'train':
@@ -133,11 +133,12 @@ def fit(loss_fn, data, bnds, pbnds, p_name, p_priors,
     Args: 
 
         loss_fn: a function; log likelihood function
-        data:  a dictionary, each key map a dataframe
+        data:  a dictionary, each key map a dataframe or a dict
+               of column arrays
         bnds: parameter bound
         pbnds: possible bound, used to initialize parameter
-        priors: a list of scipy random variable, used to
-                calculate log prior
+        priors: a fastPrior of the parameters, used
+                to calculate log prior
         p_name: the names of parameters
         method: decide if we use the prior -'mle', -'map', -'hier'
         alg: the fiting algorithm, currently we can use 
@@ -159,7 +160,7 @@ def fit(loss_fn, data, bnds, pbnds, p_name, p_priors,
     if method=='mle': p_priors=None 
     if alg=='BFGS': bnds=None
     # get the number of trial 
-    n_rows = np.sum([data[k].shape[0] for k in data.keys()])
+    n_rows = np.sum([len(data[k]['block_type']) for k in data.keys()])
 
     # Init params
     if init:
@@ -206,11 +207,12 @@ def fit_parallel(pool, loss_fn, data, bnds, pbnds, p_name,
     Args: 
         pool:  computing pool; mp.pool
         loss_fn: a function; log likelihood function
-        data:  a dictionary, each key map a dataframe
+        data:  a dictionary, each key map a dataframe or a dict
+               of column arrays
         bnds: parameter bound
         pbnds: possible bound, used to initialize parameter
-        priors: a list of scipy random variable, used to
-                calculate log prior
+        priors: a fastPrior of the parameters, used
+                to calculate log prior
         p_name: the names of parameters
         method: decide if we use the prior -'mle', -'map', -'hier'
         alg: the fiting algorithm, currently we can use 
@@ -250,6 +252,25 @@ def fit_parallel(pool, loss_fn, data, bnds, pbnds, p_name,
             
     return opt_res 
 
+def fit_sequential(loss_fn, data, bnds, pbnds, p_name,              
+                   p_priors, method='mle', alg='Nelder-Mead', 
+                   init=False, seed=2021, verbose=False, n_fits=40):
+    '''Fit the parameter using optimization, the n_fits 
+    restarts run one by one in this process
+
+    Same args and seeds as fit_parallel, so both return
+    the same fit. Used when no pool is given.
+    '''
+    opt_val   = np.inf 
+    for i in range(n_fits):
+        res = fit(loss_fn, data, bnds, pbnds, p_name, p_priors,             
+                  method, alg, init, seed+2*i, verbose)
+        if -res['log_post'] < opt_val:
+            opt_val = -res['log_post']
+            opt_res = res
+            
+    return opt_res 
+
 # ------------------------------------------------------#
 #             Bayesian group level comparison           #
 # ------------------------------------------------------#
@@ -1,7 +1,10 @@
+import math
 import numpy as np 
 import pandas as pd 
  
-from scipy.special import softmax 
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 from scipy.stats import gamma, uniform, beta
 
 from utils.fit import *
@@ -23,11 +26,161 @@ def get_param_name(params, block_types=['sta', 'vol'], feedback_types=['gain', '
                                                for j in block_types])
 
 def clip_exp(x):
-    x = np.clip(x, a_min=-max_, a_max=50)
-    return np.exp(x) 
+    # scalars skip numpy; the lower clip is dropped 
+    # because exp of a large negative is just 0.
+    if isinstance(x, (float, int)):
+        return math.exp(min(x, 50.))
+    x = np.minimum(x, 50.)
+    return np.exp(x, out=x) if isinstance(x, np.ndarray) else np.exp(x)
 
 sigmoid = lambda x: 1 / (1+clip_exp(-x))
 
+# ------------------------------#
+#          Fast priors          #
+# ------------------------------#
+
+def _norm_logpdf(x, loc, scale, c):
+    z = (x-loc) / scale
+    return c - .5*z*z
+
+def _xlogy(x, y):
+    '''x*log(y) with 0*log(0) = 0, as scipy.special.xlogy
+    '''
+    if x == 0: return 0.
+    if y == 0: return -np.inf if x > 0 else np.inf
+    return x*math.log(y)
+
+def _xlog1py(x, y):
+    '''x*log(1+y) with 0*log(0) = 0, as scipy.special.xlog1py
+    '''
+    if x == 0: return 0.
+    if y == -1: return -np.inf if x > 0 else np.inf
+    return x*math.log1p(y)
+
+def _gamma_logpdf(x, a, loc, scale, c):
+    z = (x-loc) / scale
+    if not z >= 0: return -np.inf
+    return c + _xlogy(a-1, z) - z
+
+def _beta_logpdf(x, a, b, loc, scale, c):
+    z = (x-loc) / scale
+    if not 0 <= z <= 1: return -np.inf
+    return c + _xlogy(a-1, z) + _xlog1py(b-1, -z)
+
+def _uniform_logpdf(x, loc, scale, c):
+    return c if loc <= x <= loc+scale else -np.inf
+
+# closed forms of each family
+_logpdfs = {'norm': _norm_logpdf, 'gamma': _gamma_logpdf,
+            'beta': _beta_logpdf, 'uniform': _uniform_logpdf}
+
+def _closed_form(prior):
+    '''Family name and constants of the closed-form 
+    logpdf of a frozen scipy prior, (None, None) if 
+    the family is not supported
+    '''
+    # _parse_args is private to scipy, fall back to logpdf if it fails
+    try:
+        shapes, loc, scale = prior.dist._parse_args(*prior.args, **prior.kwds)
+        name = prior.dist.name
+    except Exception:
+        return None, None
+    if name == 'norm':
+        c = -math.log(scale) - .5*math.log(2*math.pi)
+        return name, dict(loc=loc, scale=scale, c=c)
+    elif name == 'gamma':
+        a = shapes[0]
+        c = -math.lgamma(a) - math.log(scale)
+        return name, dict(a=a, loc=loc, scale=scale, c=c)
+    elif name == 'beta':
+        a, b = shapes
+        c = math.lgamma(a+b) - math.lgamma(a) - math.lgamma(b) - math.log(scale)
+        return name, dict(a=a, b=b, loc=loc, scale=scale, c=c)
+    elif name == 'uniform':
+        return name, dict(loc=loc, scale=scale, c=-math.log(scale))
+    else:
+        return None, None
+
+def to_fast_logpdf(prior):
+    '''Closed-form logpdf of a frozen scipy prior
+
+    Skips the argument checking of the frozen dist.
+    Families other than norm, gamma, beta and uniform
+    fall back to prior.logpdf. Partials, not lambdas,
+    so they can be sent to the pool.
+    '''
+    name, kwargs = _closed_form(prior)
+    if name is None: return prior.logpdf
+    return partial(_logpdfs[name], **kwargs)
+
+class fastPrior:
+    '''Log prior of all the parameters
+
+    The closed-form logpdfs are built once, see
+    to_fast_logpdf. Each logpdf is clipped at -max_, 
+    and a nan logpdf counts as -max_.
+    '''
+
+    def __init__(self, p_priors):
+        self.logpdfs = [to_fast_logpdf(pri) for pri in p_priors]
+
+    def __call__(self, params):
+        lpr, neg = 0., -max_
+        for fn, x in zip(self.logpdfs, params):
+            v = fn(x)
+            # v > neg is False for nan
+            lpr += v if v > neg else neg
+        return lpr
+
+# ------------------------------#
+#        Compiled kernels       #
+# ------------------------------#
+
+@njit(cache=True, nogil=True)
+def _rl_learn(p1, alpha, delta, p_S):
+    '''Delta rule update of p(S=1), return p1 
+    and write p(S) in place
+    '''
+    p1 = p1 + alpha*delta
+    p_S[0] = 1-p1
+    p_S[1] = p1
+    return p1
+
+@njit(cache=True, nogil=True)
+def _rl_policy(beta, p_S, m, pi):
+    '''Softmax over the expected utility of the 
+    two actions, written into pi
+
+    For two actions the softmax is a sigmoid of the
+    utility difference, so only one exp is needed.
+    The small prob is e/(1+e) with e = exp(-|d|), 
+    which keeps it accurate in the tail.
+    '''
+    d = beta*(p_S[1]*m[1] - p_S[0]*m[0])
+    e = np.exp(-abs(d))
+    big = 1 / (1+e)
+    if d >= 0:
+        pi[0], pi[1] = e*big, big
+    else:
+        pi[0], pi[1] = big, e*big
+    return pi
+
+@njit(cache=True, nogil=True, fastmath=True)
+def _rl_block_loglike(alpha, beta, p1, s, a, m, train):
+    '''Per-trial log likelihood of a whole block, the 
+    trial loop of eval_fn with the RL policy and 
+    learning compiled into one call
+    '''
+    p_S = np.array([1-p1, p1])
+    pi  = np.empty(2)
+    ll  = np.empty(s.shape[0])
+    for t in range(s.shape[0]):
+        _rl_policy(beta, p_S, m[t], pi)
+        ll[t] = np.log(pi[a[t]]+eps_)
+        if train[t]:
+            p1 = _rl_learn(p1, alpha, s[t]-p1, p_S)
+    return ll
+
 # ------------------------------#
 #         Agent wrapper         #
 # ------------------------------#
@@ -46,13 +199,36 @@ class wrapper:
         self.agent  = agent
         self.env_fn = env_fn
         self.use_hook = False
+        self._env_cache = {}
+
+    def _get_env(self, block_type):
+        '''The env only depends on the block type, 
+        so build it once and reuse it 
+        '''
+        if block_type not in self._env_cache:
+            self._env_cache[block_type] = self.env_fn(block_type)
+        return self._env_cache[block_type]
     
     # ------------ fit ------------ #
 
     def fit(self, data, method, alg, pool=None, p_priors=None,
             init=False, seed=2021, verbose=False, n_fits=40):
         '''Fit the parameter using optimization 
+
+        With a pool, the n_fits restarts run in parallel;
+        without one, they run one by one in this process.
+        Note: without a pool this used to run a single fit,
+        it now also runs n_fits; pass n_fits=1 for one fit.
         '''
+        # turn the dataframes into arrays once,
+        # and build the envs before they are sent to the pool
+        data = self._preprocess(data)
+        for k in data.keys(): self._get_env(data[k]['block_type'][0])
+
+        # turn the priors into closed-form logpdfs once
+        if p_priors is None: p_priors = self.agent.p_priors
+        if p_priors is not None and not isinstance(p_priors, fastPrior): 
+            p_priors = fastPrior(p_priors)
 
         # get functional inputs 
         fn_inputs = [self.loss_fn, 
@@ -60,7 +236,7 @@ class wrapper:
                      self.agent.p_bnds,
                      self.agent.p_pbnds, 
                      self.agent.p_name,
-                     self.agent.p_priors if p_priors is None else p_priors,
+                     p_priors,
                      method,
                      alg, 
                      init,
@@ -70,10 +246,38 @@ class wrapper:
         if pool:
             sub_fit = fit_parallel(pool, *fn_inputs, n_fits=n_fits)
         else: 
-            sub_fit = fit(*fn_inputs)  
+            sub_fit = fit_sequential(*fn_inputs, n_fits=n_fits)
 
         return sub_fit      
 
+    @staticmethod
+    def _use_block_fn(env, subj):
+        '''Use the compiled block likelihood only if neither 
+        the env nor the agent changed the trial dynamics
+        '''
+        return hasattr(env, 'eval_block_fn') and env.has_block_eval() \
+                and subj.has_block_loglike()
+
+    @staticmethod
+    def _to_arrays(block_data):
+        '''Turn a block dataframe into a dict of column arrays
+        '''
+        return {c: block_data[c].to_numpy() for c in block_data.columns}
+
+    def _prep_block(self, block_data):
+        '''Turn one block into column arrays, the env 
+        can add its derived arrays with prep_fn
+        '''
+        block = self._to_arrays(block_data)
+        if hasattr(self.env_fn, 'prep_fn'): block = self.env_fn.prep_fn(block)
+        return block
+
+    def _preprocess(self, data):
+        '''Turn each block of the data into column arrays,
+        so no pandas is touched in the likelihood loop
+        '''
+        return {k: self._prep_block(data[k]) for k in data.keys()}
+
     def loss_fn(self, params, sub_data, p_priors=None):
         '''Total likelihood
 
@@ -84,129 +288,182 @@ class wrapper:
             or Maximum a posterior 
             log p(θ|D) = \sum_i log p(D_i|θ ) + log p(θ)
         '''
+        # from gauss space to actual space, once per call
+        tparams = self.agent.trans_params(params)
         # negative log likelihood
-        tot_loglike_loss  = -np.sum([self.loglike(params, sub_data[key])
-                    for key in sub_data.keys()])
+        tot_loglike_loss = 0.
+        for key in sub_data.keys():
+            tot_loglike_loss -= self.loglike(tparams, sub_data[key], True)
         # negative log prior 
         tot_logprior_loss = 0 if p_priors==None else \
             -self.logprior(params, p_priors)
         # sum
         return tot_loglike_loss + tot_logprior_loss
 
-    def loglike(self, params, block_data):
+    def loglike(self, params, block, is_transformed=False):
         '''Likelihood for one sample
         -log p(D_i|θ )
         In RL, each sample is a block of experiment,
         Because it is independent across experiment.
+        The block is a dict of column arrays, see _preprocess;
+        a dataframe is converted here, once per call.
+        Set is_transformed if params are already in actual space.
         '''
+        if isinstance(block, pd.DataFrame): block = self._prep_block(block)
+
         # init subject and load block type
-        block_type = block_data.loc[0, 'block_type']
-        env  = self.env_fn(block_type)
-        subj = self.agent(env, params)
+        block_type = block['block_type'][0]
+        n_rows = len(block['block_type'])
+        env  = self._get_env(block_type)
+        subj = self.agent(env, params, is_transformed)
         ll   = 0
+
+        # a compiled block likelihood skips the trial loop
+        if self._use_block_fn(env, subj):
+            return env.eval_block_fn(block, subj).sum()
        
         ## loop to simulate the responses in the block 
-        for _, row in block_data.iterrows():
+        for t in range(n_rows):
 
             # predict stage: obtain input
-            ll += env.eval_fn(row, subj)
+            ll += env.eval_fn(block, t, subj)
 
         return ll
           
     def logprior(self, params, p_priors):
         '''Add the prior of the parameters
+        p_priors is a fastPrior, see fit, or a list 
+        of frozen scipy priors
         '''
-        lpr = 0
-        for pri, param in zip(p_priors, params):
-            lpr += np.max([pri.logpdf(param), -max_])
-        return lpr
+        if not isinstance(p_priors, fastPrior): p_priors = fastPrior(p_priors)
+        return p_priors(params)
 
     # ------------ evaluate ------------ #
 
-    def eval(self, data, params):
-        sim_data = [] 
-        for block_id in data.keys():
-            block_data = data[block_id].copy()
-            sim_data.append(self.eval_block(block_data, params))
-        return pd.concat(sim_data, ignore_index=True)
+    def eval(self, data, params, n_threads=None):
+        '''Evaluate the fit on each block
+
+        With n_threads, the blocks are evaluated in a thread 
+        pool. Agents with a compiled block_loglike compute 
+        the per-trial ll without the GIL, so the threads run
+        in parallel there; otherwise the Python trial loop
+        holds the GIL. The restarts and subjects stay on the 
+        process pool, see fit_parallel.
+        '''
+        blocks = [data[block_id] for block_id in data.keys()]
+        if n_threads:
+            with ThreadPoolExecutor(n_threads) as executor:
+                preds = list(executor.map(
+                    partial(self.eval_block, params=params), blocks))
+        else:
+            preds = [self.eval_block(block_data, params) 
+                     for block_data in blocks]
+        return self._merge(blocks, preds)
     
     def eval_block(self, block_data, params):
+        '''Evaluate one block, return the predicted 
+        values and their column names
+        '''
 
         # init subject and load block type
-        block_type = block_data.loc[0, 'block_type']
-        env  = self.env_fn(block_type)
+        block = self._prep_block(block_data)
+        block_type = block['block_type'][0]
+        env  = self._get_env(block_type)
         subj = self.agent(env, params)
 
-        ## init a blank dataframe to store variable of interest
-        col = ['ll'] + self.agent.voi
-        init_mat = np.zeros([block_data.shape[0], len(col)]) + np.nan
-        pred_data = pd.DataFrame(init_mat, columns=col)  
+        ## init a blank array, only ll is recorded
+        n_rows  = block_data.shape[0]
+        col     = ['ll']
+        ll_arr  = np.empty(n_rows)
+        # to record the agent voi, run the trial loop below
+        # (skip the compiled branch) and uncomment these
+        # col += self.agent.voi
+        # voi_arr = np.empty([n_rows, len(self.agent.voi)])
+        # voi_getters = [getattr(subj, f'get_{v}') for v in self.agent.voi]
+
+        ## the compiled per-trial ll releases the GIL
+        if self._use_block_fn(env, subj):
+            ll_arr = env.eval_block_fn(block, subj)
+            return ll_arr[:, np.newaxis], col
 
         ## loop to simulate the responses in the block
-        for t, row in block_data.iterrows():
+        for t in range(n_rows):
 
             # record some insights of the model
-            # for v in self.agent.voi:
-            #     pred_data.loc[t, v] = eval(f'subj.get_{v}()')
+            # for i, fn in enumerate(voi_getters):
+            #     voi_arr[t, i] = fn()
 
             # simulate the data 
-            ll = env.eval_fn(row, subj)
+            ll = env.eval_fn(block, t, subj)
             
             # record the stimulated data
-            pred_data.loc[t, 'll'] = ll
+            ll_arr[t] = ll
 
-        # drop nan columns
-        pred_data = pred_data.dropna(axis=1, how='all')
-            
-        return pd.concat([block_data, pred_data], axis=1)
+        # return np.column_stack([ll_arr, voi_arr]), col
+        return ll_arr[:, np.newaxis], col
 
     # ------------ simulate ------------ #
 
     def sim(self, data, params, rng):
-        sim_data = [] 
+        blocks, preds = [], [] 
         for block_id in data.keys():
-            block_data = data[block_id].copy()
-            for v in self.env_fn.voi:
-                if v in block_data.columns:
-                    block_data = block_data.drop(columns=v)
-            sim_data.append(self.sim_block(block_data, params, rng))
+            # drop returns a new dataframe, no copy needed
+            block_data = data[block_id].drop(columns=self.env_fn.voi, errors='ignore')
+            blocks.append(block_data)
+            preds.append(self.sim_block(block_data, params, rng))
         
-        return pd.concat(sim_data, ignore_index=True)
+        return self._merge(blocks, preds)
 
     def sim_block(self, block_data, params, rng):
+        '''Simulate one block, return the simulated 
+        values and their column names
+        '''
 
         # init subject and load block type
-        block_type = block_data.loc[0, 'block_type']
-        env  = self.env_fn(block_type)
+        block = self._to_arrays(block_data)
+        block_type = block['block_type'][0]
+        env  = self._get_env(block_type)
         subj = self.agent(env, params)
 
-        ## init a blank dataframe to store variable of interest
-        col = self.env_fn.voi + self.agent.voi
-        init_mat = np.zeros([block_data.shape[0], len(col)]) + np.nan
-        pred_data = pd.DataFrame(init_mat, columns=col)  
+        ## init blank arrays to store variable of interest
+        n_rows      = block_data.shape[0]
+        col         = self.env_fn.voi + self.agent.voi
+        env_voi_arr = np.empty([n_rows, len(env.voi)])
+        voi_arr     = np.empty([n_rows, len(self.agent.voi)])
+
+        ## cache the getters of the model insights
+        voi_getters = [getattr(subj, f'get_{v}') for v in self.agent.voi]
+        if self.use_hook:
+            insight_getters = {k: getattr(subj, f'get_{k}') for k in self.insights.keys()}
 
         ## loop to simulate the responses in the block
-        for t, row in block_data.iterrows():
+        for t in range(n_rows):
 
             # simulate the data 
-            subj_voi = env.sim_fn(row, subj, rng)
+            subj_voi = env.sim_fn(block, t, subj, rng)
 
             # record some insights of the model
-            for i, v in enumerate(self.agent.voi):
-                pred_data.loc[t, v] = eval(f'subj.get_{v}()')
+            for i, fn in enumerate(voi_getters):
+                voi_arr[t, i] = fn()
 
             # if register hook to get the model insights
             if self.use_hook:
-                for k in self.insights.keys():
-                    self.insights[k].append(eval(f'subj.get_{k}()'))
+                for k, fn in insight_getters.items():
+                    self.insights[k].append(fn())
 
             # record the stimulated data
-            for i, v in enumerate(env.voi): 
-                pred_data.loc[t, v] = subj_voi[i]
+            env_voi_arr[t, :] = subj_voi
 
-        # drop nan columns
-        pred_data = pred_data.dropna(axis=1, how='all')
-            
+        return np.column_stack([env_voi_arr, voi_arr]), col
+
+    @staticmethod
+    def _merge(blocks, preds):
+        '''Stack the blocks and their predictions,
+        building each dataframe only once
+        '''
+        col = preds[0][1]
+        pred_data = pd.DataFrame(np.vstack([p for p, _ in preds]), columns=col)
+        block_data = pd.concat(blocks, ignore_index=True)
         return pd.concat([block_data, pred_data], axis=1)
     
     def register_hooks(self, *args):
@@ -218,21 +475,23 @@ class wrapper:
 # ------------------------------#
 
 class simpleBuffer:
-    '''Simple Buffer 2.0
+    '''Simple Buffer 3.0
     Update log: 
         To prevent naive writing mistakes,
         we turn the list storage into dict.
+        3.0: the store is refilled in place,
+        so no dict is rebuilt on every push.
     '''
     def __init__(self):
         self.m = {}
-        
+
     def push(self, m_dict):
-        self.m = {k: m_dict[k] for k in m_dict.keys()}
+        self.m.clear()
+        self.m.update(m_dict)
         
     def sample(self, *args):
-        lst = [self.m[k] for k in args]
-        if len(lst)==1: return lst[0]
-        else: return lst
+        if len(args)==1: return self.m[args[0]]
+        else: return [self.m[k] for k in args]
 
 # ------------------------------#
 #          Base model           #
@@ -247,19 +506,35 @@ class baseAgent:
     p_name   = []  
     n_params = 0 
     p_priors = None 
+    p_trans  = []
     # value of interest, used for output
     # the interesting variable in simulation
     voi      = []
     
-    def __init__(self, nA, params):
+    def __init__(self, nA, params, is_transformed=False):
         self.nA = nA 
+        if not is_transformed: params = self.trans_params(params)
         self.load_params(params)
         self._init_believes()
         self._init_buffer()
 
+    @classmethod
+    def trans_params(cls, params):
+        '''From gauss space to actual space,
+        unchanged if the agent has no p_trans
+        '''
+        if not cls.p_trans: return params
+        return [fn(p) for fn, p in zip(cls.p_trans, params)]
+
     def load_params(self, params): 
         return NotImplementedError
 
+    def has_block_loglike(self):
+        '''If the agent has a compiled block_loglike
+        that matches its learn and policy
+        '''
+        return False
+
     def _init_buffer(self):
         self.mem = simpleBuffer()
     
@@ -296,9 +571,7 @@ class RL(baseAgent):
     color    = viz.r2 
    
     def load_params(self, params):
-        # from gauss space to actual space
-        params = [fn(p) for fn, p in zip(self.p_trans, params)]
-        # assign the parameter
+        # assign the parameter, already in actual space
         self.alpha = params[0]
         self.beta  = params[1]
 
@@ -307,20 +580,36 @@ class RL(baseAgent):
         self.p1     = 1/2
         self.p_S   = np.array([1-self.p1, self.p1]) 
 
+    def _init_actor(self):
+        # filled in place by the policy
+        self.pi    = np.empty(2)
+
     def learn(self):
         self._learn_critic()
 
     def _learn_critic(self):
-        s, t, f = self.mem.sample('s', 't_type', 'f_type')
+        s = self.mem.sample('s')
         delta = s-self.p1
         o = 'pos' if delta>0 else 'neg'
         self.o = o 
-        self.p1 += self.alpha * delta 
-        self.p_S = np.array([1-self.p1, self.p1])
+        self.p1 = _rl_learn(self.p1, self.alpha, delta, self.p_S)
 
     def policy(self, m, **kwargs):
-        self.pi = softmax(self.beta*self.p_S*m)
-        return self.pi
+        return _rl_policy(self.beta, self.p_S, m, self.pi)
+
+    def has_block_loglike(self):
+        # subclasses that change the dynamics must 
+        # not be fit with the RL kernel 
+        cls = type(self)
+        return all(getattr(cls, f) is getattr(RL, f) 
+                   for f in ['learn', '_learn_critic', 'policy'])
+
+    def block_loglike(self, s, a, m, train):
+        '''Per-trial log likelihood of a whole block 
+        in one compiled call
+        '''
+        return _rl_block_loglike(self.alpha, self.beta, self.p1, 
+                                 s, a, m, train)
 
     def get_pS1(self):
         return self.p_S[1]